@@ -11,6 +11,11 @@ from beets import library, plugins, ui
 from beets.dbcore import query
 from mpd.asyncio import MPDClient
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 mpd_config = beets.config["mpd"]
 music_dir = beets.config["directory"].get(str)
 
@@ -33,9 +38,14 @@ class MPDDjPlugin(plugins.BeetsPlugin):
         )
         mpd_config["password"].redact = True
 
+        # Maps queued item paths to their (item id, album id), as the queue is re-read
+        # often. Only paths that are still in the queue are kept.
+        self.item_ids: dict[str, tuple[int, int]] = {}
+
     def commands(self):
         def _func(lib, opts, args):
-            asyncio.run(self.run(lib, opts, args))
+            loop_factory = uvloop.new_event_loop if uvloop else None
+            asyncio.run(self.run(lib, opts, args), loop_factory=loop_factory)
 
         cmd = ui.Subcommand("dj", help="Auto-add songs to the MPD queue")
         cmd.parser.add_option(
@@ -76,18 +86,31 @@ class MPDDjPlugin(plugins.BeetsPlugin):
         """From a list of paths to items, return a set of the unique items in the list."""
 
         items = set()
+        item_ids = {}
 
         for path in item_paths:
-            path_query = library.PathQuery("path", path)
-            item = lib.items(path_query).get()
+            if path not in item_ids:
+                item_ids[path] = self.item_ids.get(path) or self.lookup_ids(lib, path)
+            item_id, album_id = item_ids[path]
 
             if opts.album:
-                items.add(item.get_album().get("id", 0))
+                items.add(album_id)
             else:
-                items.add(item.id)
+                items.add(item_id)
+
+        # Drop songs that left the queue, so they are looked up afresh if re-queued.
+        self.item_ids = item_ids
 
         return items
 
+    def lookup_ids(self, lib: library.Library, path: str) -> tuple[int, int]:
+        """Return the item id and album id of the item at the path."""
+
+        path_query = library.PathQuery("path", path)
+        item = lib.items(path_query).get()
+
+        return (item.id, item.get("album_id") or 0)
+
     def get_items(
         self, lib: library.Library, opts: optparse.Values, args: list[str], num: int
     ) -> list[str]:
@@ -121,8 +144,6 @@ class MPDQueue(MPDClient):
 
         self = MPDQueue(lib, log)
 
-        self.disconnect()
-
         try:
             await self.connect(mpd_config["host"].get(), mpd_config["port"].get())
             self.password(mpd_config["password"].get())
@@ -1,17 +1,27 @@
 """A Beets plugin to track MPD playback status."""
 
 import asyncio
+import bisect
+import contextlib
 import logging
 import os
+import signal
 import time
 import typing
+from array import array
 
 import beets
 from beets import library, plugins, ui
 from beets.dbcore import types
+from mpd import ConnectionError as MPDConnectionError
 from mpd import MPDError
 from mpd.asyncio import MPDClient
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 mpd_config = beets.config["mpd"]
 music_dir = beets.config["directory"].get(str)
 time_format = beets.config["time_format"].get(str)
@@ -53,7 +63,11 @@ class MPDTrackerPlugin(plugins.BeetsPlugin):
 
     def commands(self):
         def _func(lib, _opts, _args):
-            asyncio.run(self.run(lib))
+            loop_factory = uvloop.new_event_loop if uvloop else None
+            try:
+                asyncio.run(self.run(lib), loop_factory=loop_factory)
+            except asyncio.CancelledError:
+                self._log.debug("Tracker stopped.")
 
         cmd = ui.Subcommand(
             "tracker",
@@ -68,13 +82,34 @@ class MPDTrackerPlugin(plugins.BeetsPlugin):
 
         mpd_tracker = await MPDTracker.initialize(self.config, self._log)
 
-        while True:
-            (song, playback_status) = await mpd_tracker.run()
+        # Ctrl-C already cancels the main task, handle SIGTERM the same way.
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel
+            )
 
-            if playback_status == "played":
-                self.set_played(lib, song)
-            elif playback_status == "skipped":
-                self.set_skipped(lib, song)
+        try:
+            while True:
+                try:
+                    (song, playback_status) = await mpd_tracker.run()
+                except (MPDConnectionError, ConnectionError) as exc:
+                    # python-mpd2 raises a bare ConnectionError when the socket closes.
+                    self._log.warning(
+                        "Lost connection to MPD: {}", str(exc) or type(exc).__name__
+                    )
+                    await mpd_tracker.reconnect()
+                    continue
+
+                if playback_status == "played":
+                    self.set_played(lib, song)
+                elif playback_status == "skipped":
+                    self.set_skipped(lib, song)
+        except asyncio.CancelledError:
+            # Don't lose the song that was playing when the tracker was stopped. Only
+            # record plays, as stopping the tracker early in a song isn't a skip.
+            if mpd_tracker.tracking and mpd_tracker.playback_status() == "played":
+                self.set_played(lib, mpd_tracker.song)
+            raise
 
     def set_played(self, lib: library.Library, song: dict):
         """Increment the `play_count` flexible attribute for the item, and set `last_played`
@@ -84,33 +119,75 @@ class MPDTrackerPlugin(plugins.BeetsPlugin):
         attribuite of the songs in the album.
         """
 
-        query = library.PathQuery("path", os.path.join(music_dir, song["file"]))
-        item = lib.items(query).get()
+        # Store the song and album in a single transaction.
+        with lib.transaction():
+            query = library.PathQuery("path", os.path.join(music_dir, song["file"]))
+            item = lib.items(query).get()
+            previously_played_at = item.get("last_played")
+
+            # set song metadata
+            item["play_count"] = item.get("play_count", 0) + 1
+            item["last_played"] = time.time()
+            item.store()
+            self._log.info(
+                "{} played {} times at {}",
+                item,
+                item["play_count"],
+                FormattedTime(item["last_played"]),
+            )
+
+            # set album metadata
+            album = item.get_album()
+            if album and self.album_may_change(album, previously_played_at):
+                oldest_last_played = self.oldest_last_played(lib, album)
+
+                if oldest_last_played:
+                    album["last_played"] = oldest_last_played
+                    album.store(inherit=False)
+                    self._log.info(
+                        "{} last played at {}",
+                        album,
+                        FormattedTime(album["last_played"]),
+                    )
+
+    def album_may_change(
+        self, album: library.Album, previously_played_at: float | None
+    ) -> bool:
+        """Whether playing a song may change the album's `last_played` attribute.
+
+        The album's `last_played` is the oldest of its songs', so replaying any song
+        other than the oldest one leaves it as is.
+        """
 
-        # set song metadata
-        item["play_count"] = item.get("play_count", 0) + 1
-        item["last_played"] = time.time()
-        item.store()
-        self._log.info(
-            "{} played {} times at {}",
-            item,
-            item["play_count"],
-            time.strftime(time_format, time.localtime(item["last_played"])),
-        )
+        album_last_played = album.get("last_played")
 
-        # set album metadata
-        album = item.get_album()
-        if album:
-            songs_last_played_at = [song.get("last_played") for song in album.items()]
+        if album_last_played is None or previously_played_at is None:
+            return True
+        return previously_played_at <= album_last_played
 
-            if all(songs_last_played_at):
-                album["last_played"] = min(songs_last_played_at)
-                album.store(inherit=False)
-                self._log.info(
-                    "{} last played at {}",
-                    album,
-                    time.strftime(time_format, time.localtime(album["last_played"])),
-                )
+    def oldest_last_played(
+        self, lib: library.Library, album: library.Album
+    ) -> float | None:
+        """Return the oldest `last_played` value of the songs in the album.
+
+        Returns `None` if any song in the album has never been played. The value is
+        aggregated by SQLite, instead of loading every item in the album.
+        """
+
+        with lib.transaction() as tx:
+            ((song_count, played_count, oldest),) = tx.query(
+                "SELECT COUNT(*), COUNT(NULLIF(attr.value, '')),"
+                " MIN(CAST(attr.value AS REAL))"
+                " FROM items"
+                " LEFT JOIN item_attributes AS attr"
+                " ON attr.entity_id = items.id AND attr.key = 'last_played'"
+                " WHERE items.album_id = ?",
+                (album.id,),
+            )
+
+        if song_count == 0 or played_count < song_count:
+            return None
+        return oldest
 
     def set_skipped(self, lib: library.Library, song: dict):
         """Increment the `skip_count` flexible attribute for the item."""
@@ -123,41 +200,82 @@ class MPDTrackerPlugin(plugins.BeetsPlugin):
         item.store()
 
 
+class FormattedTime:
+    """A timestamp, formatted with beets' `time_format` only when logged."""
+
+    __slots__ = ("timestamp",)
+
+    def __init__(self, timestamp: float) -> None:
+        self.timestamp = timestamp
+
+    def __str__(self) -> str:
+        return time.strftime(time_format, time.localtime(self.timestamp))
+
+
 class PlaybackHistory:
-    """Store playback history as a list of play/pause positions."""
+    """Store playback history as sorted, non-overlapping play ranges.
+
+    The start and end positions of the ranges are kept in two parallel arrays.
+    """
+
+    __slots__ = (
+        "log",
+        "duration",
+        "starts",
+        "ends",
+        "total_play_time",
+        "play_from_pos",
+        "play_from_time",
+    )
 
     def __init__(self, log: logging.Logger, duration: float) -> None:
         self.log = log
 
         self.duration = duration
-        self.history = []
+        self.starts = array("d")
+        self.ends = array("d")
+        self.total_play_time = 0
         self.play_from_pos = 0
         self.play_from_time = 0
-        self.expected_end = 0
 
     def play_from(
         self,
         position: float,
     ):
-        """Record history of playback start. Recalculate expected end time."""
+        """Record history of playback start."""
 
         self.log.debug("playing from {}", position)
 
         self.play_from_pos = position
-        self.play_from_time = time.time()
-        self.expected_end = time.time() + self.duration - position
+        self.play_from_time = time.monotonic()
 
     def play_to(self, position: float):
         """Add play range to history."""
 
         self.log.debug("played to {}", position)
 
-        self.history.append((self.play_from_pos, position))
+        self.add_range(self.play_from_pos, position)
+
+    def add_range(self, start: float, end: float):
+        """Merge a play range into the history, and update the total play time."""
 
-    def play_to_now(self):
-        """Add play range to history. Extrapolate range end from current time."""
+        if end <= start:
+            return
 
-        self.play_to(self.play_from_pos + time.time() - self.play_from_time)
+        # Ranges are disjoint and sorted, so both their starts and ends are ascending.
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+            self.total_play_time -= sum(self.ends[first:last]) - sum(
+                self.starts[first:last]
+            )
+
+        self.starts[first:last] = array("d", [start])
+        self.ends[first:last] = array("d", [end])
+        self.total_play_time += end - start
 
     def play_to_end(self):
         """Assume played to end of song."""
@@ -166,34 +284,32 @@ class PlaybackHistory:
     def clear(self):
         """Clear history."""
 
-        self.history = []
+        del self.starts[:]
+        del self.ends[:]
+        self.total_play_time = 0
         self.play_from_pos = 0
         self.play_from_time = 0
-        self.expected_end = 0
 
-    def play_time(self) -> float:
-        """Calculate how many seconds of the song were played, based on the playback ranges."""
+    def reset(self, duration: float):
+        """Clear history, to start tracking a new song."""
 
-        if not self.history:
-            return 0
+        self.duration = duration
+        self.clear()
+
+    def position(self) -> float:
+        """Extrapolate the current playback position from when playback last started."""
 
-        self.history.sort(key=lambda x: x[0])
+        return self.play_from_pos + time.monotonic() - self.play_from_time
 
-        total_play_time = 0
-        current_start = self.history[0][0]
-        current_end = self.history[0][1]
+    def is_near_end(self, position: float) -> bool:
+        """Whether the extrapolated position is at the end of the song."""
 
-        for start, end in self.history[1:]:
-            if start <= current_end:
-                current_end = max(current_end, end)
-            else:
-                total_play_time += current_end - current_start
-                current_start = start
-                current_end = end
+        return abs(position - self.duration) < 1
 
-        total_play_time += current_end - current_start
+    def play_time(self) -> float:
+        """Return how many seconds of the song were played, based on the playback ranges."""
 
-        return total_play_time
+        return self.total_play_time
 
 
 class MPDTracker(MPDClient):
@@ -205,7 +321,10 @@ class MPDTracker(MPDClient):
     """
 
     song: dict
+    song_id: str | None
     playback_history: PlaybackHistory
+    play_threshold: float
+    skip_threshold: float
 
     def __init__(
         self, config: beets.IncludeLazyConfig, log: logging.Logger, *args, **kwargs
@@ -214,6 +333,12 @@ class MPDTracker(MPDClient):
 
         self.log = log
         self.config = config
+        self.tracking = False
+        self.playback_history = PlaybackHistory(log, 0)
+        self.reconnect_delay = 0
+
+        # Kept open for the lifetime of the tracker, and shared between songs.
+        self.player_events = self._player_events()
 
     @classmethod
     async def initialize(
@@ -223,16 +348,49 @@ class MPDTracker(MPDClient):
 
         self = MPDTracker(config, log)
 
-        self.disconnect()
-
         try:
-            await self.connect(mpd_config["host"].get(), mpd_config["port"].get())
-            self.password(mpd_config['password'].get())
+            await self.connect_mpd()
         except Exception as exc:
             raise ui.UserError(f"Connection failed: {exc}") from exc
 
         return self
 
+    async def connect_mpd(self):
+        """Connect to MPD using the `mpd` config."""
+
+        await self.connect(mpd_config["host"].get(), mpd_config["port"].get())
+        self.password(mpd_config['password'].get())
+
+    async def reconnect(self):
+        """Reconnect to MPD after the connection was lost.
+
+        Retries with exponential backoff, so MPD can be restarted without stopping
+        the tracker. The song being tracked when the connection was lost is dropped.
+        The delay carries over between calls, and is only reset once a song has been
+        tracked, so a server that accepts connections and then drops them is not
+        retried back to back.
+        """
+
+        self.tracking = False
+        self.disconnect()
+
+        while True:
+            if self.reconnect_delay:
+                self.log.debug("Reconnecting in {}s.", self.reconnect_delay)
+                await asyncio.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(max(self.reconnect_delay * 2, 0.5), 30)
+
+            try:
+                await self.connect_mpd()
+                break
+            except (MPDConnectionError, OSError) as exc:
+                self.log.debug("Reconnect failed: {}", str(exc) or type(exc).__name__)
+
+        self.log.info("Reconnected to MPD.")
+
+        # The old event stream was closed by the connection error.
+        self.player_events = self._player_events()
+
     async def run(self) -> tuple[dict, typing.Literal["played", "skipped", "neither"]]:
         """Main initializer for the tracker.
 
@@ -241,192 +399,240 @@ class MPDTracker(MPDClient):
         """
 
         # Load a song
-        while (await self.status()).get("state") == "stop":
+        status, self.song = await self.status_and_song()
+        if status.get("state") == "stop":
             self.log.debug("Player stopped. Waiting for song.")
-            async for _ in self.idle(["player"]):
-                break
-
-        self.song = await self.currentsong()
-        self.playback_history = PlaybackHistory(self.log, float(self.song["duration"]))
-
-        self.log.debug(f"Start tracking: {self.song['artist']} - {self.song['title']}")
+            async for status in self.player_events:
+                if status.get("state") != "stop":
+                    break
+            self.song = await self.currentsong()
+
+        self.song_id = self.song.get("id")
+        duration = float(self.song["duration"])
+        self.playback_history.reset(duration)
+        self.set_thresholds(duration)
+
+        self.log.debug(
+            "Start tracking: {} - {}", self.song.get("artist"), self.song.get("title")
+        )
 
         # Start tracking
-        task = asyncio.create_task(self._task())
-        await task
+        self.tracking = True
+        await self._task(status)
+        self.tracking = False
+        self.reconnect_delay = 0
 
         return (self.song, self.playback_status())
 
-    async def _task(self) -> PlaybackHistory:
-        elapsed = (await self.status()).get("elapsed")
-        if elapsed:
-            self.playback_history.play_to(float(elapsed))
-            self.playback_history.play_from(float(elapsed))
+    async def _task(self, status: dict) -> None:
+        if status.get("elapsed"):
+            elapsed = self.elapsed(status)
+            self.playback_history.play_to(elapsed)
+            self.playback_history.play_from(elapsed)
 
-        status = await self.status()
+        try:
+            async for new_status in self.player_events:
+                state = status.get("state")
 
-        async for _ in self.idle(["player"]):
-            state = status.get("state")
+                status = new_status
 
-            status = await self.status()
-            song = await self.currentsong()
+                if state == "play":
+                    song_done = self.handle_play_state(status)
 
-            if state == "play":
-                song_done = self.handle_play_state(status, song)
+                elif state == "pause":
+                    song_done = self.handle_pause_state(status)
 
-            elif state == "pause":
-                song_done = self.handle_pause_state(status, song)
+                elif state == "stop":
+                    self.playback_history.clear()
+                    song_done = True
 
-            elif state == "stop":
-                self.playback_history.clear()
-                song_done = True
+                if song_done:
+                    break
 
-            if song_done:
-                break
+        except asyncio.CancelledError:
+            # Tracker stopped mid-song, so count the song as played up to now.
+            if status.get("state") == "play":
+                self.playback_history.play_to(self.playback_history.position())
+            raise
 
-    def handle_play_state(self, status: dict, song: dict) -> bool:
+    async def status_and_song(self) -> tuple[dict, dict]:
+        """Fetch the player status and the current song together.
+
+        The asyncio client doesn't support command lists, so both commands are queued
+        at once instead of waiting on the status before sending `currentsong`.
+        """
+
+        status, song = await asyncio.gather(self.status(), self.currentsong())
+        return (status, song)
+
+    async def _player_events(self) -> typing.AsyncIterator[dict]:
+        """Yield the player status once for every change to the player subsystem.
+
+        A single idle subscription is shared, and the status is only fetched once per
+        event, so every handler works off the same snapshot. Breaking out of an
+        `async for` doesn't close the generator, so it is reused from song to song.
+        """
+
+        async for _ in self.idle(["player"]):
+            yield await self.status()
+
+    def handle_play_state(self, status: dict) -> bool:
         """Handle events that may occur when state=='play'."""
 
         song_done = False
+        # Read the clock once, so every check sees the same position.
+        position = self.playback_history.position()
 
-        if self.is_pause(status, song):
-            try:
-                self.playback_history.play_to(float(status["elapsed"]))
-            except Exception as exc:
-                raise NoElapsedError() from exc
-
-        elif self.is_seek(status, song):
-            self.playback_history.play_to_now()
-            try:
-                self.playback_history.play_from(float(status["elapsed"]))
-            except Exception as exc:
-                raise NoElapsedError() from exc
+        if self.is_pause(status):
+            self.playback_history.play_to(self.elapsed(status))
 
-        elif self.is_replay(status, song):
+        elif self.is_replay(status, position):
             self.playback_history.play_to_end()
             song_done = True
 
-        elif self.is_new_song(status, song):
-            self.playback_history.play_to_now()
+        elif self.is_seek(status, position):
+            self.playback_history.play_to(position)
+            self.playback_history.play_from(self.elapsed(status))
+
+        elif self.is_new_song(status):
+            self.playback_history.play_to(position)
             song_done = True
 
-        elif self.is_stop(status):
+        elif self.is_stop(status, position):
             self.playback_history.clear()
             song_done = True
 
-        elif self.is_playlist_end(status):
+        elif self.is_playlist_end(status, position):
             self.playback_history.play_to_end()
             song_done = True
 
         return song_done
 
-    def handle_pause_state(self, status: dict, song: dict) -> bool:
+    def handle_pause_state(self, status: dict) -> bool:
         """Handle events that may occor when state=='pause'."""
 
         song_done = False
+        position = self.playback_history.position()
 
-        if self.is_play(status, song):
-            try:
-                self.playback_history.play_from(float(status["elapsed"]))
-            except Exception as exc:
-                raise NoElapsedError() from exc
+        if self.is_play(status):
+            self.playback_history.play_from(self.elapsed(status))
 
-        elif self.is_new_song(status, song):
-            self.playback_history.play_to_now()
+        elif self.is_new_song(status):
+            self.playback_history.play_to(position)
             song_done = True
 
-        elif self.is_stop(status):
+        elif self.is_stop(status, position):
             self.playback_history.clear()
             song_done = True
 
         return song_done
 
-    def is_play(self, status: dict, song: dict) -> bool:
+    def elapsed(self, status: dict) -> float:
+        """Return the playback position reported by MPD."""
+
+        elapsed = status.get("elapsed")
+        if elapsed is None:
+            raise NoElapsedError()
+        return float(elapsed)
+
+    def is_play(self, status: dict) -> bool:
         """Start playback."""
 
-        return status.get("state") == "play" and self.song == song
+        return status.get("state") == "play" and self.is_same_song(status)
 
-    def is_pause(self, status: dict, song: dict):
+    def is_pause(self, status: dict):
         """Playback paused."""
 
-        return status.get("state") == "pause" and self.song == song
+        return status.get("state") == "pause" and self.is_same_song(status)
 
-    def is_seek(self, status: dict, song: dict) -> bool:
+    def is_seek(self, status: dict, position: float) -> bool:
         """Player seeked.
 
-        This requires the time we expect the song to naturally end, so that it can be
-        differentiated from `replay` events.
+        Detected by the reported position straying from where we expect playback to be.
+        Check `is_replay` first, as a replay also jumps back to the start of the song.
         """
 
         return (
             status.get("state") == "play"
-            and self.song == song
-            and 1 < abs(time.time() - self.playback_history.expected_end)
+            and self.is_same_song(status)
+            and "elapsed" in status
+            and 1 < abs(float(status["elapsed"]) - position)
         )
 
-    def is_replay(self, status: dict, song: dict) -> bool:
+    def is_replay(self, status: dict, position: float) -> bool:
         """Song replayed.
 
-        This requires the time we expect the song to naturally end, so that it can be
-        differentiated from `seek_to` events.
+        This requires the song to be expected to naturally end, so that it can be
+        differentiated from `seek` events.
         """
 
         return (
             status.get("state") == "play"
-            and self.song == song
-            and abs(time.time() - self.playback_history.expected_end) < 1
+            and self.is_same_song(status)
+            and self.playback_history.is_near_end(position)
         )
 
-    def is_new_song(self, status: dict, song: dict) -> bool:
+    def is_new_song(self, status: dict) -> bool:
         """New song queued in player."""
 
         return (
             status.get("state") == "play" or status.get("state") == "pause"
-        ) and self.song != song
+        ) and not self.is_same_song(status)
+
+    def is_same_song(self, status: dict) -> bool:
+        """Player is on the tracked song.
 
-    def is_stop(self, status: dict) -> bool:
+        MPD gives every queue entry a unique id, which is also reported by `status`, so
+        the current song doesn't need to be fetched and compared.
+        """
+
+        return status.get("songid") == self.song_id
+
+    def is_stop(self, status: dict, position: float) -> bool:
         """Player stopped.
 
-        This requires the time we expect the song to naturally end, so that it can be
+        This requires the song to not be expected to naturally end, so that it can be
         differentiated from `playlist_end` events.
         """
 
-        return status.get("state") == "stop" and 1 < abs(
-            time.time() - self.playback_history.expected_end
+        return status.get("state") == "stop" and not self.playback_history.is_near_end(
+            position
         )
 
-    def is_playlist_end(self, status: dict) -> bool:
+    def is_playlist_end(self, status: dict, position: float) -> bool:
         """Reached end of playlist.
 
-        This requires the time we expect the song to naturally end, so that it can be
+        This requires the song to be expected to naturally end, so that it can be
         differentiated from `stop` events.
         """
 
-        return (
-            status.get("state") == "stop"
-            and abs(time.time() - self.playback_history.expected_end) < 1
+        return status.get("state") == "stop" and self.playback_history.is_near_end(
+            position
+        )
+
+    def set_thresholds(self, duration: float):
+        """Calculate the play and skip threshold times for the song."""
+
+        self.play_threshold = min(
+            self.config["play_time"].get(int),
+            duration * self.config["play_percent"].get(float),
+        )
+        self.skip_threshold = max(
+            self.config["skip_time"].get(int),
+            duration * self.config["skip_percent"].get(float),
         )
 
     def playback_status(self) -> typing.Literal["played", "skipped", "neither"]:
-        """Calculate the play and skip threshold times, return playback state for song."""
+        """Return playback state for song, based on the play and skip thresholds."""
 
         play_time = self.playback_history.play_time()
 
         if play_time == 0:
             return "neither"
 
-        play_threshold = min(
-            self.config["play_time"].get(int),
-            float(self.song["duration"]) * self.config["play_percent"].get(float),
-        )
-        skip_threshold = max(
-            self.config["skip_time"].get(int),
-            float(self.song["duration"]) * self.config["skip_percent"].get(float),
-        )
-
-        if play_threshold < play_time:
+        if self.play_threshold < play_time:
             return "played"
-        if play_time < skip_threshold:
+        if play_time < self.skip_threshold:
             return "skipped"
         return "neither"
 